@@ -3,13 +3,20 @@
 __author__ = 'BinglanLi'
 
 import sys
+import time
 from pathlib import Path
-from timeit import default_timer as timer
 from typing import List
 
 import preprocessor
 
 
+def print_timing(stage: str, start_ns: int):
+    """
+    Prints how long a stage took, given its start time from time.perf_counter_ns().
+    """
+    print('[timing] stage=%s elapsed=%.3fs' % (stage, (time.perf_counter_ns() - start_ns) / 1e9))
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -97,8 +104,11 @@
 
     try:
         # make sure we have required tools
+        t0: int = time.perf_counter_ns()
         m_bcftools_path = preprocessor.validate_bcftools(args.path_to_bcftools)
         m_bgzip_path = preprocessor.validate_bgzip(args.path_to_bgzip)
+        if args.verbose:
+            print_timing('validate', t0)
 
         script_dir: Path = Path(globals().get("__file__", "./_")).absolute().parent
 
@@ -144,7 +154,12 @@
             m_pharmcat_regions_bed = None
 
         # prep pharmcat_positions helper files
+        t0 = time.perf_counter_ns()
         preprocessor.prep_pharmcat_positions(m_pharmcat_positions_vcf, m_reference_genome, verbose=args.verbose)
+        if args.verbose:
+            print_timing('prep', t0)
+        # these are read repeatedly by bcftools, so start loading them into the page cache
+        preprocessor.prefetch_pharmcat_positions(m_pharmcat_positions_vcf, m_reference_genome, verbose=args.verbose)
 
         # validate input vcf or file list
         vcf_path: Path = Path(args.vcf)
@@ -161,12 +176,7 @@
             m_vcf_files.append(vcf_path)
             m_input_basename = preprocessor.get_vcf_basename(vcf_path)
         else:
-            if args.verbose:
-                print("Looking up VCF files listed in", vcf_path)
-            with open(vcf_path, 'r') as in_f:
-                for line in in_f:
-                    line = line.strip()
-                    m_vcf_files.append(preprocessor.validate_file(line))
+            m_vcf_files = preprocessor.read_vcf_list_file(vcf_path, verbose=args.verbose)
             m_input_basename = vcf_path.stem
 
         if len(m_vcf_files) == 0:
@@ -177,12 +187,15 @@
         if args.no_gvcf_check:
             print('\nBypass the gVCF check.\n')
         else:
+            t0 = time.perf_counter_ns()
             for file in m_vcf_files:
                 if preprocessor.is_gvcf_file(file):
                     print('%s is a gVCF file, which is not currently supported.\n'
                           'See https://github.com/PharmGKB/PharmCAT/issues/79 for details.\n'
                           'If this is not a gVCF file, use -G to bypass.' % str(file))
                     sys.exit(1)
+            if args.verbose:
+                print_timing('gvcf_check', t0)
 
         m_samples: List[str] = []
         if args.sample_file:
@@ -209,8 +222,17 @@
             m_max_processes = preprocessor.check_max_processes(args.max_concurrent_processes)
         elif args.max_concurrent_processes is not None:
             print("-cp/--max_processes will be ignored (not running in multiprocess mode)")
+        # give each bcftools call a couple of extra (de)compression threads when running concurrently
+        m_bcftools_threads: int = 2 if args.concurrent_mode else 1
+
+        start: int = time.perf_counter_ns()
 
-        start = timer()
+        # index input files up front (concurrently, in concurrent mode) instead of while extracting PGx regions
+        preprocessor.index_vcf_files(m_vcf_files, concurrent_mode=args.concurrent_mode, max_processes=m_max_processes,
+                                     bcftools_threads=m_bcftools_threads, verbose=args.verbose)
+        if args.verbose:
+            print_timing('index', start)
+        t0 = time.perf_counter_ns()
 
         # normalize variant representations and reconstruct multi-allelic variants in the input VCF
         if args.verbose:
@@ -231,9 +253,12 @@
                                           reference_regions_to_retain=m_pharmcat_regions_bed,
                                           concurrent_mode=args.concurrent_mode,
                                           max_processes=m_max_processes,
+                                          bcftools_threads=m_bcftools_threads,
                                           verbose=args.verbose,
                                           )
-        end = timer()
+        if args.verbose:
+            print_timing('preprocess', t0)
+        end: int = time.perf_counter_ns()
         if len(results) == 1:
             print()
             print('Generated PharmCAT-ready VCF:', str(results[0].absolute()))
@@ -244,7 +269,7 @@
                 print('* %s' % str(rez))
         print()
         print("Done.")
-        print("Preprocessed input VCF in %.2f seconds" % (end - start))
+        print("Preprocessed input VCF in %.2f seconds" % ((end - start) / 1e9))
 
     except preprocessor.ReportableException as e:
         print(e)
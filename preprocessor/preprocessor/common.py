@@ -17,6 +17,7 @@
 UNIALLELIC_VCF_SUFFIX = '.uniallelic.vcf.bgz'
 UNIALLELIC_VCF_FILENAME = 'pharmcat_positions' + UNIALLELIC_VCF_SUFFIX
 CHR_RENAME_MAP_FILENAME = 'chr_rename_map.tsv'
+PREP_STAMP_FILENAME = 'pharmcat_positions.prep.stamp'
 
 # paths
 SCRIPT_DIR: Path = Path(globals().get("__file__", "./_")).absolute().parent
@@ -11,7 +11,8 @@ def preprocess(pharmcat_positions_vcf: Path, reference_genome: Path,
                output_dir: Path, output_basename: Optional[str] = '', split_samples: bool = False,
                keep_intermediate_files: bool = False, missing_to_ref: bool = False,
                retain_specific_regions: bool = False, reference_regions_to_retain: Path = None,
-               concurrent_mode: bool = False, max_processes: int = 1, verbose: int = 0) -> List[Path]:
+               concurrent_mode: bool = False, max_processes: int = 1, bcftools_threads: int = 1,
+               verbose: int = 0) -> List[Path]:
     """
     Normalize and prepare the input VCF for PharmCAT.
     """
@@ -34,13 +35,14 @@ def preprocess(pharmcat_positions_vcf: Path, reference_genome: Path,
                                   output_dir, basename,
                                   keep_intermediate_files, missing_to_ref,
                                   retain_specific_regions, reference_regions_to_retain,
-                                  concurrent_mode, max_processes, verbose)
+                                  concurrent_mode, max_processes, bcftools_threads, verbose)
     if split_samples and len(samples) > 1:
         util.index_vcf(multisample_vcf, verbose)
         # output PharmCAT-ready single-sample VCF
         # retain only the PharmCAT allele defining positions in the output VCF file
         results = util.export_single_sample_vcf(multisample_vcf, samples, output_dir, basename,
-                                                concurrent_mode=concurrent_mode, max_processes=max_processes)
+                                                concurrent_mode=concurrent_mode, max_processes=max_processes,
+                                                bcftools_threads=bcftools_threads, verbose=verbose)
         if not keep_intermediate_files:
             util.delete_vcf_and_index(multisample_vcf, verbose=verbose)
         return results
@@ -55,7 +57,8 @@ def preprocess_multiple_files(pharmcat_positions_vcf: Path, reference_genome: Pa
                               output_dir: Path, output_basename: Optional[str] = '',
                               keep_intermediate_files: bool = False, missing_to_ref: bool = False,
                               retain_specific_regions: bool = False, reference_regions_to_retain: Path = None,
-                              concurrent_mode: bool = False, max_processes: int = 1, verbose: int = 0) -> List[Path]:
+                              concurrent_mode: bool = False, max_processes: int = 1, bcftools_threads: int = 1,
+                              verbose: int = 0) -> List[Path]:
     """
     Normalize and prepare the input VCF for PharmCAT.
     """
@@ -83,7 +86,7 @@ def preprocess_multiple_files(pharmcat_positions_vcf: Path, reference_genome: Pa
                                       output_dir, basename,
                                       keep_intermediate_files, missing_to_ref,
                                       retain_specific_regions, reference_regions_to_retain,
-                                      concurrent_mode, max_processes, verbose)
+                                      concurrent_mode, max_processes, bcftools_threads, verbose)
         results.append(finalize_multisample_vcf(multisample_vcf, output_dir, basename))
 
     return results
@@ -94,7 +97,7 @@ def _preprocess(pharmcat_positions_vcf: Path, reference_genome: Path,
                 output_dir: Path, output_basename: Optional[str] = '',
                 keep_intermediate_files: bool = False, missing_to_ref: bool = False,
                 retain_specific_regions: bool = False, reference_regions_to_retain: Path = None,
-                concurrent_mode=False, max_processes=1, verbose: int = 0) -> Path:
+                concurrent_mode=False, max_processes=1, bcftools_threads: int = 1, verbose: int = 0) -> Path:
 
     # shrink input VCF down to PGx allele defining regions and selected samples
     # modify input VCF chromosomes naming format to <chr##>
@@ -102,16 +105,18 @@ def _preprocess(pharmcat_positions_vcf: Path, reference_genome: Path,
                                                     output_dir, output_basename,
                                                     retain_specific_regions, reference_regions_to_retain,
                                                     concurrent_mode=concurrent_mode, max_processes=max_processes,
-                                                    verbose=verbose)
+                                                    bcftools_threads=bcftools_threads, verbose=verbose)
     # normalize the input VCF
-    normalized_vcf = util.normalize_vcf(reference_genome, pgx_region_vcf, output_dir, output_basename, verbose=verbose)
+    normalized_vcf = util.normalize_vcf(reference_genome, pgx_region_vcf, output_dir, output_basename,
+                                        concurrent_mode=concurrent_mode, max_processes=max_processes,
+                                        bcftools_threads=bcftools_threads, verbose=verbose)
 
     # extract the specific PGx genetic variants in the reference PGx VCF
     # this step also generates a report of missing PGx positions in the input VCF
     pgx_variants_vcf: Path = util.extract_pgx_variants(pharmcat_positions_vcf, reference_genome, normalized_vcf,
                                                        output_dir, output_basename, missing_to_ref=missing_to_ref,
                                                        retain_specific_regions=retain_specific_regions,
-                                                       verbose=verbose)
+                                                       bcftools_threads=bcftools_threads, verbose=verbose)
 
     if not keep_intermediate_files:
         util.delete_vcf_and_index(pgx_region_vcf, verbose=verbose)
@@ -1,24 +1,29 @@
 #! /usr/bin/env python
 __author__ = 'BinglanLi'
 
+import atexit
 import concurrent.futures
 import copy
+import functools
 import gzip
+import hashlib
+import math
 import os
 import re
 import shutil
+import stat
 import subprocess
 import tarfile
 import tempfile
 import textwrap
+import threading
 import urllib.parse
 import urllib.request
 from concurrent.futures import ALL_COMPLETED
 from pathlib import Path
-from typing import Optional, Union, List
+from typing import Dict, Optional, Union, List
 from urllib.error import HTTPError
 
-import pandas as pd
 from packaging import version
 
 from . import common
@@ -40,6 +45,12 @@
                      "90338345", "83257441", "80373285", "58617616", "64444167",
                      "46709983", "50818468", "156040895", "57227415", "16569"]
 _missing_pgx_var_suffix = '.missing_pgx_var'
+_vcf_file_re = re.compile('\\.vcf(\\.b?gz)?$')
+_gvcf_file_re = re.compile('\\.(g|genomic)\\.vcf(\\.b?gz)?')
+_vcf_basename_re = re.compile('(.+?)((\\.pgx_regions)|(\\.normalized))*\\.vcf(\\.b?gz)?$')
+# shared thread pools for concurrent bcftools jobs, by number of workers, see get_executor()
+_executors: Dict[int, concurrent.futures.ThreadPoolExecutor] = {}
+_executor_lock = threading.Lock()
 
 
 def find_uniallelic_file(pharmcat_positions: Path, must_exist: bool = True) -> Path:
@@ -49,6 +60,15 @@ def find_uniallelic_file(pharmcat_positions: Path, must_exist: bool = True) -> P
     return uniallelic_positions_vcf
 
 
+def _bcftools_threads_args(threads: int) -> List[str]:
+    """
+    Gets the bcftools arguments to use additional (de)compression threads.
+    """
+    if threads is not None and threads > 1:
+        return ['--threads', str(threads)]
+    return []
+
+
 def run(command: List[str]):
     try:
         # 'check=True' raises a 'CalledProcessError' if the subprocess does not complete
@@ -65,6 +85,37 @@ def run(command: List[str]):
             raise ReportableException('Error: Failed to run %s' % ' '.join(command))
 
 
+def run_piped(first_command: List[str], second_command: List[str]):
+    """
+    Runs first_command and pipes its output into second_command.
+    Use this to chain bcftools calls without writing (and compressing) intermediate files, in which case
+    first_command should write uncompressed BCF (-Ou) to stdout and second_command should read from stdin (-).
+    """
+    try:
+        # stderr of the first command goes to a temp file so that it can never fill up a pipe and block
+        with tempfile.TemporaryFile(mode='w+') as first_stderr:
+            first = subprocess.Popen(first_command, stdout=subprocess.PIPE, stderr=first_stderr)
+            second = subprocess.Popen(second_command, stdin=first.stdout, stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE, universal_newlines=True)
+            # allow first command to receive a SIGPIPE if second command exits early
+            first.stdout.close()
+            _, second_err = second.communicate()
+            first.wait()
+            first_stderr.seek(0)
+            first_err = first_stderr.read()
+    except FileNotFoundError as e:
+        raise ReportableException('Error: %s not found' % e.filename)
+
+    if first.returncode != 0:
+        if first_err:
+            raise ReportableException(first_err)
+        raise ReportableException('Error: Failed to run %s' % ' '.join(first_command))
+    if second.returncode != 0:
+        if second_err:
+            raise ReportableException(second_err)
+        raise ReportableException('Error: Failed to run %s' % ' '.join(second_command))
+
+
 def run_pharmcat(jar_location: Path, args: List[str], max_processes: int, max_memory: Optional[str] = None,
                  verbose: int = 0):
     command: List[str] = [common.JAVA_PATH, '-cp', str(jar_location.absolute())]
@@ -227,6 +278,35 @@ def validate_file(file: Union[Path, str]) -> Path:
     return file
 
 
+def validate_files(files: List[Union[Path, str]], max_workers: int = 32) -> List[Path]:
+    """
+    Checks that all the specified files exist.
+    Files are checked concurrently, which helps when there are a lot of them on a network filesystem.
+
+    :raises ReportableException: listing every file that does not exist or is not a file
+    """
+    paths: List[Path] = [Path(f) if isinstance(f, str) else f for f in files]
+    if len(paths) == 0:
+        return paths
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as e:
+        errors: List[Optional[str]] = list(e.map(_check_file, paths))
+    errors = [err for err in errors if err is not None]
+    if len(errors) > 0:
+        raise ReportableException('\n'.join(errors))
+    return paths
+
+
+def _check_file(file: Path) -> Optional[str]:
+    try:
+        if stat.S_ISREG(os.stat(file).st_mode):
+            return None
+        return "Error: %s is not a file" % file
+    except FileNotFoundError:
+        return "Error: %s does not exist" % file
+    except OSError as e:
+        return "Error: cannot access %s (%s)" % (file, e.strerror)
+
+
 def find_vcf_files(vcf_dir: Path, verbose: int = 0) -> List[Path]:
     """
     Finds all VCF files in the specified directory.
@@ -295,12 +375,17 @@ def find_file(filename: str, dirs: List[Path]) -> Optional[Path]:
     return file
 
 
-def is_vcf_file(file: Union[Path, str]):
-    return re.search('\\.vcf(\\.b?gz)?$', str(file)) is not None
+def is_vcf_file(file: Union[Path, str]) -> bool:
+    return _is_vcf_filename(str(file))
+
 
+@functools.lru_cache(maxsize=1024)
+def _is_vcf_filename(filename: str) -> bool:
+    return _vcf_file_re.search(filename) is not None
 
-def is_gvcf_file(file: Path):
-    return re.search('\\.(g|genomic)\\.vcf(\\.b?gz)?', str(file)) or _is_gvcf_file(file)
+
+def is_gvcf_file(file: Path) -> bool:
+    return _gvcf_file_re.search(str(file)) is not None or _is_gvcf_file(file)
 
 
 def _is_gvcf_file(file: Path) -> bool:
@@ -313,16 +398,30 @@ def _is_gvcf_file(file: Path) -> bool:
             return _check_for_gvcf(in_f)
 
 
-def _check_for_gvcf(in_f) -> bool:
+def _check_for_gvcf(in_f, max_records: int = 1000) -> bool:
+    """
+    Checks the header for gVCF markers, only looking at (up to max_records) records if the header is ambiguous.
+    """
+    has_end_info: bool = False
+    num_records: int = 0
     for line in in_f:
         if line[0] == '#':
-            continue
-        else:
-            line = line.rstrip('\n')
-            fields: List[str] = line.split('\t')
-            # check whether input is a block gVCF
-            if re.search('END', fields[7]):
+            # GATK-style gVCF
+            if line.startswith('##ALT=<ID=NON_REF'):
                 return True
+            if line.startswith('##INFO=<ID=END,'):
+                has_end_info = True
+            continue
+        # block gVCFs use the END tag, so without it in the header there is no need to look at the records
+        if not has_end_info:
+            return False
+        fields: List[str] = line.rstrip('\n').split('\t')
+        # check whether input is a block gVCF
+        if re.search('(^|;)END=', fields[7]):
+            return True
+        num_records += 1
+        if num_records >= max_records:
+            break
     return False
 
 
@@ -334,7 +433,7 @@ def get_vcf_basename(path: Union[Path, str]) -> str:
     """
     if not isinstance(path, Path):
         path = Path(path)
-    match = re.search('(.+?)((\\.pgx_regions)|(\\.normalized))*\\.vcf(\\.b?gz)?$', path.name)
+    match = _vcf_basename_re.search(path.name)
     if not match:
         raise InappropriateVCFSuffix(path)
     return match.group(1)
@@ -370,6 +469,18 @@ def read_sample_file(sample_file: Path, verbose: int = 0) -> List[str]:
     return samples
 
 
+def read_vcf_list_file(list_file: Path, verbose: int = 0) -> List[Path]:
+    """
+    Reads a file of paths to VCF files (one file per line), ignoring blank lines.
+
+    :raises ReportableException: if any of the listed files does not exist
+    """
+    if verbose:
+        print("Looking up VCF files listed in", list_file)
+    lines: List[str] = [line.strip() for line in list_file.read_text().splitlines()]
+    return validate_files([line for line in lines if line])
+
+
 def read_vcf_samples(vcf_file: Path, verbose: int = 0) -> List[str]:
     """
     Obtain a list of samples from the input VCF.
@@ -389,6 +500,16 @@ def read_vcf_samples(vcf_file: Path, verbose: int = 0) -> List[str]:
     return vcf_sample_list
 
 
+def read_vcf_contigs(vcf_file: Path) -> List[str]:
+    """
+    Obtain the list of contigs that have records in the (indexed) input VCF, in index order.
+
+    "bcftools index -s" prints one line per contig: name, length and number of records.
+    """
+    output = subprocess.check_output([common.BCFTOOLS_PATH, 'index', '-s', str(vcf_file)], universal_newlines=True)
+    return [line.split('\t')[0] for line in output.splitlines() if line]
+
+
 def is_gz_file(file: Path):
     """
     Checks whether a file is bgzip compressed.
@@ -453,19 +574,91 @@ def find_index_file(vcf_file: Path) -> Optional[Path]:
     return None
 
 
-def index_vcf(vcf_file: Path, verbose: int = 0) -> Path:
+def prefetch_files(files: List[Optional[Path]], verbose: int = 0) -> List[Path]:
+    """
+    Tells the OS that the specified files will be read soon, so that it can start reading them into the page cache in
+    the background.  Missing files are ignored.
+    Does nothing on platforms without posix_fadvise (e.g. Windows and macOS).
+
+    :return: the files that were prefetched
+    """
+    prefetched: List[Path] = []
+    if not hasattr(os, 'posix_fadvise'):
+        return prefetched
+    for file in files:
+        if file is None or not file.is_file():
+            continue
+        if verbose >= 2:
+            print('  * Prefetching', file)
+        try:
+            fd = os.open(file, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+            prefetched.append(file)
+        except OSError:
+            # this is only an optimization
+            pass
+    return prefetched
+
+
+def prefetch_pharmcat_positions(pharmcat_positions_vcf: Path, reference_genome_fasta: Path,
+                                verbose: int = 0) -> List[Path]:
+    """
+    Prefetches the files that bcftools reads repeatedly while preprocessing: the PharmCAT positions VCFs and their
+    indexes, and the reference FASTA indexes.
+    The reference FASTA itself is left out.  It is large and only PGx regions are read from it (via the indexes), so
+    prefetching it would mostly evict more useful pages from the page cache.
+
+    :return: the files that were prefetched
+    """
+    uniallelic_positions_vcf: Path = find_uniallelic_file(pharmcat_positions_vcf, must_exist=False)
+    return prefetch_files([pharmcat_positions_vcf, Path(str(pharmcat_positions_vcf) + '.csi'),
+                           uniallelic_positions_vcf, Path(str(uniallelic_positions_vcf) + '.csi'),
+                           Path(str(reference_genome_fasta) + '.fai'), Path(str(reference_genome_fasta) + '.gzi')],
+                          verbose=verbose)
+
+
+def index_vcf(vcf_file: Path, verbose: int = 0, bcftools_threads: int = 1, output_file: Optional[Path] = None) -> Path:
     """
     Index the input vcf using bcftools, and the output index file will be written to the working directory.
+
+    :param output_file: where to write the index instead of next to the vcf
     """
     if verbose >= 2:
         print('  * Generating index for %s' % vcf_file)
-    run([common.BCFTOOLS_PATH, 'index', str(vcf_file)])
-    csi_file = Path(str(vcf_file) + '.csi')
+    output_args: List[str] = [] if output_file is None else ['-o', str(output_file)]
+    run([common.BCFTOOLS_PATH, 'index'] + _bcftools_threads_args(bcftools_threads) + output_args + [str(vcf_file)])
+    csi_file = output_file if output_file is not None else Path(str(vcf_file) + '.csi')
     if not csi_file.exists():
         raise ReportableException('Cannot find indexed .csi file %s' % csi_file)
     return csi_file
 
 
+def index_vcf_files(vcf_files: List[Path], concurrent_mode: bool = False, max_processes: int = 1,
+                    bcftools_threads: int = 1, verbose: int = 0) -> List[Path]:
+    """
+    Indexes the bgzipped VCF files that don't have an index yet, so that this doesn't have to happen one file at a time
+    during preprocessing.
+    Uncompressed VCF files are skipped because they get bgzipped (and indexed) during preprocessing.
+    Existing indexes are left alone, even if they are older than the VCF file (bcftools only warns about those).
+
+    :return: the newly generated index files
+    """
+    vcf_files = [f for f in vcf_files if is_gz_file(f) and find_index_file(f) is None]
+    if len(vcf_files) == 0:
+        return []
+    if verbose:
+        print('Indexing %d VCF file(s)' % len(vcf_files))
+    if concurrent_mode and len(vcf_files) > 1:
+        e = get_executor(max_processes)
+        futures = [e.submit(index_vcf, f, verbose, bcftools_threads) for f in vcf_files]
+        concurrent.futures.wait(futures, return_when=ALL_COMPLETED)
+        return [f.result() for f in futures]
+    return [index_vcf(f, verbose, bcftools_threads) for f in vcf_files]
+
+
 def delete_vcf_and_index(vcf_file: Path, verbose: int = 0):
     """Delete compressed vcf as well as the index file."""
     if vcf_file.is_file():
@@ -530,11 +723,20 @@ def download_reference_fasta_and_index(download_dir: Union[Path, str], force_upd
     if ref_file.exists() and not force_update:
         return ref_file
 
-    tar_file = download_from_url('https://zenodo.org/record/7288118/files/GRCh38_reference_fasta.tar',
-                                 download_dir, force_update, verbose)
-    with tarfile.open(tar_file, 'r') as tar:
-        tar.extractall(path=download_dir)
-    os.remove(tar_file)
+    url = 'https://zenodo.org/record/7288118/files/GRCh38_reference_fasta.tar'
+    if verbose:
+        print('  Downloading from "%s"\n\tto "%s"' % (url, download_dir))
+    # extract while downloading instead of saving the (large) tar file and reading it back
+    # extract to a temp dir first so that an interrupted download doesn't leave a partial FASTA behind
+    with tempfile.TemporaryDirectory(dir=download_dir) as td:
+        with urllib.request.urlopen(url) as response:
+            with tarfile.open(fileobj=response, mode='r|') as tar:
+                tar.extractall(path=td)
+        for f in Path(td).iterdir():
+            target: Path = download_dir / f.name
+            if target.is_dir():
+                shutil.rmtree(target)
+            f.replace(target)
 
     return ref_file
 
@@ -562,6 +764,12 @@ def download_pharmcat_jar(download_dir: Union[Path, str], force_update: bool = F
 def prep_pharmcat_positions(pharmcat_positions_vcf: Optional[Path] = None,
                             reference_genome_fasta: Optional[Path] = None,
                             update_chr_rename_file: bool = False, verbose: int = 0):
+    """
+    Makes sure the helper files derived from pharmcat_positions and the reference FASTA are available.
+
+    A stamp of the inputs is saved next to the derived files.  If the stamp matches and all derived files exist, there
+    is nothing to do.  If the stamp does not match (i.e. either input has changed), the derived files are regenerated.
+    """
     if pharmcat_positions_vcf is None:
         # assume it's in current working directory
         pharmcat_positions_vcf = Path('pharmcat_positions.vcf.bgz')
@@ -572,15 +780,30 @@ def prep_pharmcat_positions(pharmcat_positions_vcf: Optional[Path] = None,
         # assume it's in current working directory
         reference_genome_fasta = Path(common.REFERENCE_FASTA_FILENAME)
     if not reference_genome_fasta.is_file():
-        download_reference_fasta_and_index(pharmcat_positions_vcf.parent, verbose=verbose)
+        reference_genome_fasta = download_reference_fasta_and_index(pharmcat_positions_vcf.parent, verbose=verbose)
 
     csi_file = Path(str(pharmcat_positions_vcf) + '.csi')
-    if not csi_file.is_file():
-        index_vcf(pharmcat_positions_vcf, verbose)
-
     uniallelic_positions_vcf: Path = find_uniallelic_file(pharmcat_positions_vcf, must_exist=False)
-    if not uniallelic_positions_vcf.is_file():
-        create_uniallelic_vcf(uniallelic_positions_vcf, pharmcat_positions_vcf, reference_genome_fasta)
+    stamp_file: Path = pharmcat_positions_vcf.parent / common.PREP_STAMP_FILENAME
+    stamp: str = _get_prep_stamp(pharmcat_positions_vcf, reference_genome_fasta)
+    old_stamp: Optional[str] = stamp_file.read_text().strip() if stamp_file.is_file() else None
+    derived_files: List[Path] = [csi_file, uniallelic_positions_vcf, Path(str(uniallelic_positions_vcf) + '.csi'),
+                                 common.CHR_RENAME_FILE]
+    if old_stamp == stamp and not update_chr_rename_file and all(f.is_file() for f in derived_files):
+        return
+    # derived files from before stamps were introduced are assumed to be up-to-date
+    is_stale: bool = old_stamp is not None and old_stamp != stamp
+
+    # this directory may be shared by jobs running at the same time, so derived files are built under temporary names
+    # and then swapped in, so that other jobs never see a missing index or a partially written file
+    if not csi_file.is_file() or is_stale:
+        with tempfile.TemporaryDirectory(dir=pharmcat_positions_vcf.parent) as td:
+            tmp_csi_file: Path = Path(td) / csi_file.name
+            index_vcf(pharmcat_positions_vcf, verbose, output_file=tmp_csi_file)
+            os.replace(tmp_csi_file, csi_file)
+
+    if not uniallelic_positions_vcf.is_file() or is_stale:
+        create_uniallelic_vcf(uniallelic_positions_vcf, pharmcat_positions_vcf, reference_genome_fasta, verbose)
 
     # create chromosome mapping file
     if not common.CHR_RENAME_FILE.is_file() or update_chr_rename_file:
@@ -590,6 +813,25 @@ def prep_pharmcat_positions(pharmcat_positions_vcf: Optional[Path] = None,
             for i in range(len(_chr_invalid)):
                 f.write(_chr_invalid[i] + "\t" + _chr_valid[i] + "\n")
 
+    try:
+        # written last, once all derived files are in place
+        stamp_file.write_text(stamp + '\n')
+    except OSError:
+        # not being able to save the stamp (e.g. read-only directory) just means the check is repeated next time
+        pass
+
+
+def _get_prep_stamp(pharmcat_positions_vcf: Path, reference_genome_fasta: Path) -> str:
+    """
+    Gets a hash of the name, size and modification time of the files used by prep_pharmcat_positions.
+    The directory is left out so that moving (or re-mounting) it doesn't invalidate the derived files.
+    """
+    file_hash = hashlib.sha1()
+    for file in [pharmcat_positions_vcf, reference_genome_fasta]:
+        file_stat = file.stat()
+        file_hash.update(('%s:%d:%d\n' % (file.name, file_stat.st_size, file_stat.st_mtime_ns)).encode())
+    return file_hash.hexdigest()
+
 
 def create_uniallelic_vcf(uniallelic_positions_vcf: Path, pharmcat_positions_vcf: Path, reference_genome_fasta: Path,
                           verbose: int = 0):
@@ -597,11 +839,15 @@ def create_uniallelic_vcf(uniallelic_positions_vcf: Path, pharmcat_positions_vcf
         print('* Preparing uniallelic PharmCAT positions VCF')
     # convert reference PGx variants to the uniallelic format needed for extracting exact PGx positions
     # and generating an accurate missing report
-    bcftools_command = [common.BCFTOOLS_PATH, 'norm', '--no-version', '-m-', '-c', 'ws', '-f',
-                        str(reference_genome_fasta), '-Oz', '-o', str(uniallelic_positions_vcf),
-                        str(pharmcat_positions_vcf)]
-    run(bcftools_command)
-    index_vcf(uniallelic_positions_vcf, verbose)
+    # build under a temporary name and swap it in (see prep_pharmcat_positions())
+    with tempfile.TemporaryDirectory(dir=uniallelic_positions_vcf.parent) as td:
+        tmp_vcf: Path = Path(td) / uniallelic_positions_vcf.name
+        bcftools_command = [common.BCFTOOLS_PATH, 'norm', '--no-version', '-m-', '-c', 'ws', '-f',
+                            str(reference_genome_fasta), '-Oz', '-o', str(tmp_vcf), str(pharmcat_positions_vcf)]
+        run(bcftools_command)
+        tmp_csi_file: Path = index_vcf(tmp_vcf, verbose)
+        os.replace(tmp_vcf, uniallelic_positions_vcf)
+        os.replace(tmp_csi_file, Path(str(uniallelic_positions_vcf) + '.csi'))
 
 
 def _get_vcf_pos_min_max(positions, flanking_bp=100):
@@ -626,7 +872,7 @@ def _is_valid_chr(vcf_file: Path) -> bool:
 def extract_pgx_regions(pharmcat_positions: Path, vcf_files: List[Path], samples: List[str],
                         output_dir: Path, output_basename: str,
                         retain_specific_regions: bool = False, reference_regions_to_retain: Path = None,
-                        concurrent_mode: bool = False, max_processes: int = 1,
+                        concurrent_mode: bool = False, max_processes: int = 1, bcftools_threads: int = 1,
                         verbose: int = 0) -> Path:
     """
     Extracts PGx regions from input VCF file(s) into a single VCF file and rename chromosomes to match PharmCAT
@@ -647,26 +893,25 @@ def extract_pgx_regions(pharmcat_positions: Path, vcf_files: List[Path], samples
         if len(vcf_files) == 1:
             # this should create pgx_region_vcf_file
             _extract_pgx_regions(pharmcat_positions, vcf_files[0], tmp_sample_file, output_dir, output_basename,
-                                 retain_specific_regions, reference_regions_to_retain, verbose)
+                                 retain_specific_regions, reference_regions_to_retain, bcftools_threads, verbose)
         else:
             # generate files to be concatenated
             tmp_files: List[Path] = []
             if concurrent_mode:
-                with concurrent.futures.ProcessPoolExecutor(max_workers=check_max_processes(max_processes,
-                                                                                            validate=False)) as e:
-                    futures = []
-                    for vcf_file in vcf_files:
-                        futures.append(e.submit(_extract_pgx_regions, pharmcat_positions, vcf_file, tmp_sample_file,
-                                                output_dir, get_vcf_basename(vcf_file), retain_specific_regions,
-                                                reference_regions_to_retain, verbose))
-                    concurrent.futures.wait(futures, return_when=ALL_COMPLETED)
-                    for future in futures:
-                        tmp_files.append(future.result())
+                e = get_executor(max_processes)
+                futures = []
+                for vcf_file in vcf_files:
+                    futures.append(e.submit(_extract_pgx_regions, pharmcat_positions, vcf_file, tmp_sample_file,
+                                            output_dir, get_vcf_basename(vcf_file), retain_specific_regions,
+                                            reference_regions_to_retain, bcftools_threads, verbose))
+                concurrent.futures.wait(futures, return_when=ALL_COMPLETED)
+                for future in futures:
+                    tmp_files.append(future.result())
             else:
                 for vcf_file in vcf_files:
                     tmp_files.append(_extract_pgx_regions(pharmcat_positions, vcf_file, tmp_sample_file, output_dir,
                                                           get_vcf_basename(vcf_file), retain_specific_regions,
-                                                          reference_regions_to_retain, verbose))
+                                                          reference_regions_to_retain, bcftools_threads, verbose))
             # write file names to txt file for bcftools
             tmp_file_list = tmp_dir / 'regions.txt'
             with open(tmp_file_list, 'w+') as w:
@@ -677,7 +922,7 @@ def extract_pgx_regions(pharmcat_positions: Path, vcf_files: List[Path], samples
             if verbose:
                 print('Concatenating PGx VCFs')
             bcftools_command = [common.BCFTOOLS_PATH, 'concat', '--no-version', '-a', '-f', str(tmp_file_list), '-Oz',
-                                '-o', str(pgx_region_vcf_file)]
+                                '-o', str(pgx_region_vcf_file)] + _bcftools_threads_args(bcftools_threads)
             run(bcftools_command)
             # index the VCF file
             index_vcf(pgx_region_vcf_file, verbose)
@@ -688,14 +933,20 @@ def extract_pgx_regions(pharmcat_positions: Path, vcf_files: List[Path], samples
 def _extract_pgx_regions(pharmcat_positions: Path, vcf_file: Path, sample_file: Path, output_dir: Path,
                          output_basename: Optional[str],
                          retain_specific_regions: bool = False, reference_regions_to_retain: Path = None,
-                         verbose: int = 0) -> Path:
+                         bcftools_threads: int = 1, verbose: int = 0) -> Path:
     """
     Does the actual work to extract PGx regions from input VCF file(s) into a single VCF file and
     rename chromosomes to match PharmCAT expectations.
 
     "bcftools annotate <options> <vcf_file>".
+    "-S <sample_file>" keeps only the requested samples.  This is the first bcftools pass over the input, so every
+    later stage (normalization, concatenation, splitting) only has to carry genotypes for these samples.
+    "--force-samples" is deliberately not used: a requested sample that is missing from the input is an error.
     "--rename-chrs" renames chromosomes according to the map in chr_rename_map.tsv.
     """
+    # pandas is slow to import and only needed here, so don't make every caller (e.g. --help) pay for it
+    import pandas as pd
+
     print('Processing', vcf_file, '...')
     # make sure vcf is bgzipped and indexed
     bgz_file = bgzip_vcf(vcf_file, verbose)
@@ -725,31 +976,36 @@ def _extract_pgx_regions(pharmcat_positions: Path, vcf_file: Path, sample_file:
         if len(idx_chr_m > 0):
             ref_pgx_regions = pd.concat([ref_pgx_regions, ref_pgx_regions.loc[idx_chr_m].assign(**{'CHROM': 'chrMT'})])
 
-    # validate chromosome formats
-    if _is_valid_chr(bgz_file):
-        # format the pgx regions to be extracted
-        ref_pgx_regions = ",".join(ref_pgx_regions.apply(lambda row: ':'.join(row.values.astype(str)), axis=1))
-    else:
-        # format pgx regions
-        ref_pgx_regions = ",".join(ref_pgx_regions.apply(lambda row: ':'.join(row.values.astype(str)), axis=1)
-                                   .replace({'chr': ''}, regex=True))
-
     # extract pgx regions and modify chromosome names if necessary
     if output_basename is None:
         output_basename = get_vcf_basename(vcf_file)
     pgx_regions_vcf = output_dir / (output_basename + '.pgx_regions.vcf.bgz')
-    bcftools_command = [common.BCFTOOLS_PATH, 'annotate', '--no-version', '-S', str(sample_file),
-                        '--rename-chrs', str(common.CHR_RENAME_FILE), '-r', ref_pgx_regions, '-i', 'ALT="."', '-k',
-                        '-Oz', '-o', str(pgx_regions_vcf), str(bgz_file)]
-    if verbose:
-        print('* Extracting PGx regions and normalizing chromosome names')
-    run(bcftools_command)
+    with tempfile.TemporaryDirectory() as td:
+        # write pgx regions to a file instead of passing them on the command line, which can get very long
+        # (tab-delimited CHROM, BEG, END; 1-based and inclusive because the extension is not .bed)
+        regions_file: Path = Path(td) / 'regions.tsv'
+        # validate chromosome formats
+        strip_chr: bool = not _is_valid_chr(bgz_file)
+        with open(regions_file, 'w') as w:
+            for chrom, pos in ref_pgx_regions[['CHROM', 'POS']].itertuples(index=False):
+                chrom = str(chrom).replace('chr', '') if strip_chr else str(chrom)
+                start, end = str(pos).rsplit('-', 1)
+                w.write('%s\t%s\t%s\n' % (chrom, start, end))
+
+        bcftools_command = [common.BCFTOOLS_PATH, 'annotate', '--no-version', '-S', str(sample_file),
+                            '--rename-chrs', str(common.CHR_RENAME_FILE), '-R', str(regions_file), '-i', 'ALT="."',
+                            '-k', '-Oz', '-o', str(pgx_regions_vcf)] + _bcftools_threads_args(bcftools_threads) + \
+                           [str(bgz_file)]
+        if verbose:
+            print('* Extracting PGx regions and normalizing chromosome names')
+        run(bcftools_command)
     # index the PGx VCF file
     index_vcf(pgx_regions_vcf, verbose)
     return pgx_regions_vcf
 
 
 def normalize_vcf(reference_genome: Path, vcf_file: Path, output_dir: Path, output_basename: Optional[str],
+                  concurrent_mode: bool = False, max_processes: int = 1, bcftools_threads: int = 1,
                   verbose: int = 0):
     """
     Normalize the input VCF against the human reference genome sequence GRCh38/hg38.
@@ -760,20 +1016,48 @@ def normalize_vcf(reference_genome: Path, vcf_file: Path, output_dir: Path, outp
     "-f <reference_genome_fasta>" reference sequence. Supplying this option turns on left-alignment and normalization.
     "-c ws" when incorrect or missing REF allele is encountered, warn (w) and set/fix(s) bad sites.  's' will swap
     alleles and update GT and AC counts. Importantly, 's' will NOT fix strand issues in a VCF.
+
+    In concurrent mode, each chromosome is normalized separately (using "-r <chr>" on the indexed input) and the
+    results are concatenated.
     """
     if output_basename is None:
         output_basename = get_vcf_basename(vcf_file)
     normalized_vcf = output_dir / (output_basename + '.normalized.vcf.bgz')
-    bcftools_command = [common.BCFTOOLS_PATH, 'norm', '--no-version', '-m-', '-c', 'ws',
-                        '-Oz', '-o', str(normalized_vcf),
-                        '-f', str(reference_genome), str(vcf_file)]
     if verbose:
         print('* Normalizing VCF')
-    run(bcftools_command)
+
+    contigs: List[str] = read_vcf_contigs(vcf_file) if concurrent_mode else []
+    if len(contigs) > 1:
+        with tempfile.TemporaryDirectory() as td:
+            tmp_dir: Path = Path(td)
+            e = get_executor(max_processes)
+            futures = []
+            for idx, contig in enumerate(contigs):
+                futures.append(e.submit(_normalize_region, reference_genome, vcf_file, contig,
+                                        tmp_dir / ('%d.bcf' % idx)))
+            concurrent.futures.wait(futures, return_when=ALL_COMPLETED)
+            # results must be concatenated in the original chromosome order
+            tmp_files: List[Path] = [f.result() for f in futures]
+            run([common.BCFTOOLS_PATH, 'concat', '--no-version', '-Oz', '-o', str(normalized_vcf)] +
+                _bcftools_threads_args(bcftools_threads) + [str(f) for f in tmp_files])
+    else:
+        bcftools_command = [common.BCFTOOLS_PATH, 'norm', '--no-version', '-m-', '-c', 'ws',
+                            '-Oz', '-o', str(normalized_vcf)] + _bcftools_threads_args(bcftools_threads) + \
+                           ['-f', str(reference_genome), str(vcf_file)]
+        run(bcftools_command)
     index_vcf(normalized_vcf, verbose)
     return normalized_vcf
 
 
+def _normalize_region(reference_genome: Path, vcf_file: Path, region: str, output_file: Path) -> Path:
+    """
+    Normalizes a single region of the (indexed) input VCF into an uncompressed BCF file.
+    """
+    run([common.BCFTOOLS_PATH, 'norm', '--no-version', '-m-', '-c', 'ws', '-r', region, '-Ou',
+         '-o', str(output_file), '-f', str(reference_genome), str(vcf_file)])
+    return output_file
+
+
 def _is_phased(gt_field) -> bool:
     """
     Determines the phasing status of a position.
@@ -802,7 +1086,8 @@ def _is_haploid(gt_field) -> bool:
 
 def extract_pgx_variants(pharmcat_positions: Path, reference_fasta: Path, vcf_file: Path,
                          output_dir: Path, output_basename: str, missing_to_ref: bool = False,
-                         retain_specific_regions: bool = False, verbose: int = 0) -> Path:
+                         retain_specific_regions: bool = False, bcftools_threads: int = 1,
+                         verbose: int = 0) -> Path:
     """
     Extract specific pgx positions that are present in the reference PGx VCF.
     Generate a report of PGx positions that are missing in the input VCF.
@@ -828,7 +1113,7 @@ def extract_pgx_variants(pharmcat_positions: Path, reference_fasta: Path, vcf_fi
             # extracting PGx positions from input using "bcftools view"
             selected_positions_only_bgz: Path = tmp_dir / (output_basename + '.selected_positions_or_regions.vcf.bgz')
             run([common.BCFTOOLS_PATH, 'view', '--no-version', '-T', str(uniallelic_positions_vcf), '-Oz',
-                 '-o', str(selected_positions_only_bgz), str(vcf_file)])
+                 '-o', str(selected_positions_only_bgz)] + _bcftools_threads_args(bcftools_threads) + [str(vcf_file)])
             index_vcf(selected_positions_only_bgz, verbose)
 
         # add in missing multi-allelic variants as '0|0'
@@ -1075,20 +1360,15 @@ def extract_pgx_variants(pharmcat_positions: Path, reference_fasta: Path, vcf_fi
                     else:
                         continue
 
-        # sort vcf
+        # sort vcf and make sure output complies with the multi-allelic format
+        # sorted records are streamed to "bcftools norm" as uncompressed BCF instead of going through a bgzipped file
         if verbose:
             print('* Sorting by chromosomal location...')
-        sorted_bgz: Path = tmp_dir / (output_basename + '.sorted.vcf.bgz')
-        bcftools_command = [common.BCFTOOLS_PATH, 'sort', '-Oz', '-o', str(sorted_bgz), str(updated_pgx_pos_vcf)]
-        run(bcftools_command)
-        index_vcf(sorted_bgz, verbose)
-
-        # make sure output complies with the multi-allelic format
-        if verbose:
             print('* Enforcing multi-allelic variant representation...')
         normed_bgz: Path = tmp_dir / (output_basename + '.normed.vcf.bgz')
-        run([common.BCFTOOLS_PATH, 'norm', '--no-version', '-m+', '-c', 'ws', '-f', str(reference_fasta), '-Oz',
-             '-o', str(normed_bgz), str(sorted_bgz)])
+        run_piped([common.BCFTOOLS_PATH, 'sort', '-Ou', str(updated_pgx_pos_vcf)],
+                  [common.BCFTOOLS_PATH, 'norm', '--no-version', '-m+', '-c', 'ws', '-f', str(reference_fasta), '-Oz',
+                   '-o', str(normed_bgz)] + _bcftools_threads_args(bcftools_threads) + ['-'])
 
         filtered_bgz: Path = output_dir / (output_basename + '.multiallelic.vcf.bgz')
 
@@ -1172,13 +1452,45 @@ def _print_missing_positions(pharmcat_positions: Path, ref_pos_dynamic, output_d
     return missing_pos_file
 
 
+def _split_vcf_by_sample(vcf_file: Path, samples: List[str], output_dir: Path,
+                         verbose: int = 0) -> Optional[Dict[str, Path]]:
+    """
+    Split the input VCF into one (uncompressed BCF) file per sample in a single pass.
+
+    "bcftools +split <options> <input_vcf>".
+    "-S <sample_file>" samples to keep, one per line: original sample name, new sample name ("-" to keep the original)
+        and output file name (without suffix).
+
+    :return: dictionary of sample to its file, or None if the split plugin is not available
+    """
+    sample_file: Path = output_dir / 'split_samples.txt'
+    sample_vcfs: Dict[str, Path] = {}
+    with open(sample_file, 'w+') as w:
+        for idx, sample in enumerate(samples):
+            # use generated file names so that sample names never need to be valid file names
+            w.write('%s\t-\tsample_%d\n' % (sample, idx))
+            sample_vcfs[sample] = output_dir / ('sample_%d.bcf' % idx)
+    try:
+        run([common.BCFTOOLS_PATH, '+split', '-S', str(sample_file), '-Ou', '-o', str(output_dir), str(vcf_file)])
+    except ReportableException as e:
+        if verbose:
+            print('  * Cannot split VCF with "bcftools +split", exporting samples one at a time (%s)' %
+                  str(e).strip())
+        return None
+    if not all(f.is_file() for f in sample_vcfs.values()):
+        return None
+    return sample_vcfs
+
+
 def _export_single_sample(vcf_file: Path, output_dir: Path, output_basename: str, sample: str,
-                          multisample: bool) -> Path:
+                          multisample: bool, bcftools_threads: int = 1, presplit: bool = False) -> Path:
     """
     Create final PharmCAT-ready VCF file.
 
     "bcftools view <options> <input_vcf>". For bcftools common options, see running_bcftools().
     "--force-samples" only warn about unknown subset samples
+
+    :param presplit: vcf_file only contains the specified sample (see _split_vcf_by_sample), so skip "bcftools view"
     """
     if output_basename:
         if multisample:
@@ -1189,40 +1501,121 @@ def _export_single_sample(vcf_file: Path, output_dir: Path, output_basename: str
         output_file_name = output_dir / (sample + '.preprocessed.vcf')
 
     print('Generating PharmCAT-ready VCF for', sample)
-    tmp_file: Path = output_file_name.parent / ('tmp.' + sample + '.vcf')
-    run([common.BCFTOOLS_PATH, 'view', '--no-version', '-s', sample, '-Ov',
-         '-o', str(tmp_file), str(vcf_file)])
-    run([common.BCFTOOLS_PATH, 'annotate', '--no-version', '-x', '^INFO/PX', '-s', sample, '-Ov',
-         '-o', str(output_file_name), str(tmp_file)])
-    tmp_file.unlink()
+    annotate_command = [common.BCFTOOLS_PATH, 'annotate', '--no-version', '-x', '^INFO/PX', '-s', sample, '-Ov',
+                        '-o', str(output_file_name)]
+    if presplit:
+        run(annotate_command + [str(vcf_file)])
+    else:
+        run_piped([common.BCFTOOLS_PATH, 'view', '--no-version', '-s', sample, '-Ou'] +
+                  _bcftools_threads_args(bcftools_threads) + [str(vcf_file)],
+                  annotate_command + ['-'])
     return output_file_name
 
 
 def export_single_sample_vcf(vcf_file: Path, samples: List[str], output_dir: Path, output_basename: str,
-                             concurrent_mode: bool = False, max_processes: int = 1) -> List[Path]:
+                             concurrent_mode: bool = False, max_processes: int = 1,
+                             bcftools_threads: int = 1, verbose: int = 0) -> List[Path]:
     """
     Write final PharmCAT-ready VCF for each sample.
+
+    Samples are split out of the input VCF in a single pass with "bcftools +split" if the plugin is available,
+    otherwise each sample is extracted from the input VCF individually.
     """
     is_multisample = len(samples) > 1
     results: List[Path] = []
-    if concurrent_mode:
-        with concurrent.futures.ProcessPoolExecutor(max_workers=check_max_processes(max_processes, validate=False))\
-                as executor:
+    with tempfile.TemporaryDirectory() as td:
+        sample_vcfs: Optional[Dict[str, Path]] = None
+        if is_multisample:
+            sample_vcfs = _split_vcf_by_sample(vcf_file, samples, Path(td), verbose)
+
+        presplit: bool = sample_vcfs is not None
+        if concurrent_mode:
+            executor = get_executor(max_processes)
             futures = []
             for sample in samples:
-                futures.append(executor.submit(_export_single_sample, vcf_file, output_dir, output_basename,
-                                               sample, is_multisample))
+                sample_vcf: Path = sample_vcfs[sample] if presplit else vcf_file
+                futures.append(executor.submit(_export_single_sample, sample_vcf, output_dir, output_basename,
+                                               sample, is_multisample, bcftools_threads, presplit))
             concurrent.futures.wait(futures, return_when=ALL_COMPLETED)
             for f in concurrent.futures.as_completed(futures):
                 results.append(f.result())
-    else:
-        for sample in samples:
-            results.append(_export_single_sample(vcf_file, output_dir, output_basename, sample, is_multisample))
+        else:
+            for sample in samples:
+                sample_vcf: Path = sample_vcfs[sample] if presplit else vcf_file
+                results.append(_export_single_sample(sample_vcf, output_dir, output_basename, sample, is_multisample,
+                                                     bcftools_threads, presplit))
     return results
 
 
+def get_executor(max_processes: int) -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Gets the thread pool used to run bcftools jobs concurrently.
+    The pool is created on first use and reused across calls (e.g. when preprocessing many VCF files).  There is one
+    pool per number of workers, and pools are only shut down at exit, so a pool handed out earlier is never shut down
+    under another caller.
+    All bcftools/bgzip fan-out goes through this pool so that it honors the user's concurrency settings.  The only
+    exception is validate_files(), which just stats files (no subprocesses) on its own short-lived pool.
+
+    The heavy lifting happens in bcftools subprocesses, so threads are sufficient.  htslib memory is freed when each
+    bcftools process exits, so workers never need to be recycled.
+    Jobs running on this pool must not submit jobs to it and wait for them.
+    """
+    max_workers: int = check_max_processes(max_processes, validate=False)
+    with _executor_lock:
+        if max_workers not in _executors:
+            _executors[max_workers] = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        return _executors[max_workers]
+
+
+def _shutdown_executors():
+    with _executor_lock:
+        for executor in _executors.values():
+            executor.shutdown()
+        _executors.clear()
+
+
+atexit.register(_shutdown_executors)
+
+
+def get_cpu_count() -> int:
+    """
+    Gets the number of CPUs available to this process.
+    Unlike os.cpu_count(), this takes CPU affinity (e.g. taskset, SLURM) and cgroup v2 CPU quotas (e.g. docker --cpus)
+    into account.
+    """
+    cpu_count: int = os.cpu_count() or 1
+    if hasattr(os, 'sched_getaffinity'):
+        try:
+            cpu_count = len(os.sched_getaffinity(0))
+        except OSError:
+            pass
+    cpu_limit: Optional[int] = _read_cgroup_cpu_limit(Path('/sys/fs/cgroup/cpu.max'))
+    if cpu_limit is not None:
+        cpu_count = min(cpu_count, cpu_limit)
+    return max(1, cpu_count)
+
+
+def _read_cgroup_cpu_limit(cpu_max_file: Path) -> Optional[int]:
+    """
+    Reads the CPU limit from a cgroup v2 cpu.max file, which contains "<quota> <period>" or "max <period>".
+
+    :return: the number of CPUs the quota allows for (rounded up), or None if there is no limit
+    """
+    try:
+        fields: List[str] = cpu_max_file.read_text().split()
+    except OSError:
+        return None
+    if len(fields) != 2 or fields[0] == 'max':
+        return None
+    try:
+        return max(1, math.ceil(int(fields[0]) / int(fields[1])))
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
 def check_max_processes(requested_max_processes: Optional[int], validate: bool = True, verbose: int = 0) -> int:
-    if os.cpu_count() == 1:
+    cpu_count: int = get_cpu_count()
+    if cpu_count == 1:
         if validate:
             if requested_max_processes is None:
                 print('Only 1 CPU, cannot use concurrent mode')
@@ -1232,21 +1625,21 @@ def check_max_processes(requested_max_processes: Optional[int], validate: bool =
     max_processes: int = 1
     if requested_max_processes is None:
         # don't default to concurrent mode unless more than 2 CPU
-        if os.cpu_count() == 3:
+        if cpu_count == 3:
             max_processes = 2
-        elif os.cpu_count() > 3:
-            max_processes = max(2, os.cpu_count() - 2)
+        elif cpu_count > 3:
+            max_processes = max(2, cpu_count - 2)
     else:
         max_processes = requested_max_processes
         if requested_max_processes < 1:
             max_processes = 1
             if validate:
                 raise ReportableException('Cannot ask for less than 1 concurrent process')
-        elif requested_max_processes > os.cpu_count():
-            max_processes = max(2, os.cpu_count() - 2)
+        elif requested_max_processes > cpu_count:
+            max_processes = max(2, cpu_count - 2)
             if validate:
                 print('Warning: request %s max processes, but only %s CPUs available.' %
-                      (requested_max_processes, os.cpu_count()))
+                      (requested_max_processes, cpu_count))
                 print('Will use a maximum of %s concurrent processes.' % max_processes)
 
     if os.name == 'nt' and requested_max_processes > 61:
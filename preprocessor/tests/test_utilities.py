@@ -1,3 +1,4 @@
+import io
 import os
 import shutil
 import tempfile
@@ -18,6 +19,27 @@ def test_chr_arrays():
     assert len(utils._chr_invalid) == len(utils._chr_valid)
 
 
+def test_run_piped():
+    with tempfile.TemporaryDirectory() as td:
+        tmp_file = Path(td, 'foo.txt')
+        helpers.touch(tmp_file, 'hello\nworld\n')
+        utils.run_piped(['cat', str(tmp_file)], ['grep', '-q', 'world'])
+
+        with pytest.raises(ReportableException) as context:
+            utils.run_piped(['cat', str(tmp_file)], ['grep', '-q', 'nope'])
+        assert 'Failed to run grep' in context.value.msg
+
+        with pytest.raises(ReportableException) as context:
+            utils.run_piped(['cat', td + '/does-not-exist'], ['grep', '-q', 'world'])
+        assert 'No such file' in context.value.msg
+
+
+def test_bcftools_threads_args():
+    assert [] == utils._bcftools_threads_args(None)
+    assert [] == utils._bcftools_threads_args(1)
+    assert ['--threads', '4'] == utils._bcftools_threads_args(4)
+
+
 def test_validate_tool():
     utils.validate_tool('bcftools', 'bcftools')
 
@@ -120,6 +142,26 @@ def test_validate_file():
         assert 'is not a file' in context.value.msg
 
 
+def test_validate_files():
+    assert [] == utils.validate_files([])
+
+    with tempfile.TemporaryDirectory() as td:
+        tmp_dir = Path(td)
+        f1 = tmp_dir / 'f1.vcf'
+        f2 = tmp_dir / 'f2.vcf'
+        helpers.touch(f1)
+        helpers.touch(f2)
+        assert [f1, f2] == utils.validate_files([str(f1), f2])
+
+        # all problems should be reported at once
+        with pytest.raises(ReportableException) as context:
+            utils.validate_files([f1, tmp_dir / 'missing1.vcf', tmp_dir, tmp_dir / 'missing2.vcf'])
+        assert 'missing1.vcf does not exist' in context.value.msg
+        assert 'missing2.vcf does not exist' in context.value.msg
+        assert '%s is not a file' % tmp_dir in context.value.msg
+        assert 'f1.vcf' not in context.value.msg
+
+
 def test_find_vcf_files():
     vcf_files = utils.find_vcf_files(helpers.test_dir)
     assert len(vcf_files) > 1
@@ -196,6 +238,23 @@ def test_is_gvcf_file():
         assert utils.is_gvcf_file(f)
 
 
+def test_check_for_gvcf():
+    header = '##fileformat=VCFv4.2\n'
+    end_header = '##INFO=<ID=END,Number=1,Type=Integer,Description="End position">\n'
+    columns = '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n'
+    block = 'chr1\t100\t.\tA\t<*>\t.\tPASS\tEND=200\tGT\t0/0\n'
+    snp = 'chr1\t100\t.\tA\tG\t.\tPASS\tDP=20\tGT\t0/1\n'
+
+    # NON_REF in header is enough
+    assert utils._check_for_gvcf(io.StringIO(header + '##ALT=<ID=NON_REF,Description="Any">\n' + columns))
+    # no END in header, records are never looked at
+    assert not utils._check_for_gvcf(io.StringIO(header + columns + block))
+    # END in header, need to look at records
+    assert utils._check_for_gvcf(io.StringIO(header + end_header + columns + snp + block))
+    assert not utils._check_for_gvcf(io.StringIO(header + end_header + columns + snp))
+    assert not utils._check_for_gvcf(io.StringIO(header + end_header + columns + snp + block), max_records=1)
+
+
 def test_get_vcf_basename():
     valid_paths = [
         Path('/this/dir/file.vcf'),
@@ -233,6 +292,21 @@ def test_read_sample_file():
     assert ['SAMPLE_1', 'SAMPLE_2'] == samples
 
 
+def test_read_vcf_list_file():
+    with tempfile.TemporaryDirectory() as td:
+        tmp_dir = Path(td)
+        list_file = tmp_dir / 'vcfs.txt'
+        helpers.touch(list_file, '%s\n\n  %s  \r\n\n' % (helpers.test_dir / 'raw-p1.vcf.bgz',
+                                                          helpers.test_dir / 'raw-p2.vcf.bgz'))
+        vcf_files = utils.read_vcf_list_file(list_file)
+        assert [helpers.test_dir / 'raw-p1.vcf.bgz', helpers.test_dir / 'raw-p2.vcf.bgz'] == vcf_files
+
+        helpers.touch(list_file, str(tmp_dir / 'missing.vcf'))
+        with pytest.raises(ReportableException) as context:
+            utils.read_vcf_list_file(list_file)
+        assert 'missing.vcf does not exist' in context.value.msg
+
+
 def test_read_vcf_samples():
     samples = utils.read_vcf_samples(helpers.test_dir / 'raw.Sample_1.preprocessed.vcf')
     assert samples is not None
@@ -297,6 +371,72 @@ def test_index_vcf():
         assert 's1.vcf.bgz.tbi' not in files
 
 
+def test_index_vcf_files():
+    vcf_file = Path(helpers.test_dir / 'raw.Sample_1.preprocessed.vcf')
+    with tempfile.TemporaryDirectory() as td:
+        tmp_dir: Path = Path(td)
+        tmp_file = tmp_dir / 's1.vcf'
+        shutil.copyfile(vcf_file, tmp_file)
+        # uncompressed files are skipped
+        assert utils.index_vcf_files([tmp_file]) == []
+
+        bgz_file = utils.bgzip_vcf(tmp_file)
+        assert utils.index_vcf_files([bgz_file], verbose=True) == [Path(str(bgz_file) + '.csi')]
+        # already has an index
+        assert utils.index_vcf_files([bgz_file]) == []
+
+        # existing indexes are never touched, even if they are older than the VCF file
+        tbi_file = Path(str(bgz_file) + '.tbi')
+        Path(str(bgz_file) + '.csi').rename(tbi_file)
+        os.utime(tbi_file, ns=(1_000_000_000, 1_000_000_000))
+        assert utils.index_vcf_files([bgz_file]) == []
+        assert tbi_file.is_file()
+        assert tbi_file.stat().st_mtime_ns == 1_000_000_000
+
+        # in concurrent mode, files without an index are indexed on the shared pool
+        bgz_file2 = tmp_dir / 's2.vcf.bgz'
+        bgz_file3 = tmp_dir / 's3.vcf.bgz'
+        shutil.copyfile(bgz_file, bgz_file2)
+        shutil.copyfile(bgz_file, bgz_file3)
+        expected = [Path(str(bgz_file2) + '.csi'), Path(str(bgz_file3) + '.csi')]
+        assert utils.index_vcf_files([bgz_file, bgz_file2, bgz_file3], concurrent_mode=True,
+                                     max_processes=2) == expected
+        for csi_file in expected:
+            assert csi_file.is_file()
+
+
+def test_prefetch_files():
+    with tempfile.TemporaryDirectory() as td:
+        tmp_file = Path(td, 'foo.vcf.bgz')
+        helpers.touch(tmp_file, 'hello, world')
+        # missing files and None are ignored
+        prefetched = utils.prefetch_files([tmp_file, None, Path(td, 'missing.vcf.bgz')], verbose=2)
+        if hasattr(os, 'posix_fadvise'):
+            assert prefetched == [tmp_file]
+        else:
+            assert prefetched == []
+
+
+def test_prefetch_pharmcat_positions():
+    with tempfile.TemporaryDirectory() as td:
+        tmp_dir: Path = Path(td)
+        tmp_positions = tmp_dir / preprocessor.PHARMCAT_POSITIONS_FILENAME
+        tmp_uniallelic = tmp_dir / preprocessor.UNIALLELIC_VCF_FILENAME
+        tmp_reference = tmp_dir / preprocessor.REFERENCE_FASTA_FILENAME
+        files = [tmp_positions, Path(str(tmp_positions) + '.csi'), tmp_uniallelic, Path(str(tmp_uniallelic) + '.csi'),
+                 Path(str(tmp_reference) + '.fai'), Path(str(tmp_reference) + '.gzi')]
+        for file in files + [tmp_reference]:
+            helpers.touch(file)
+
+        prefetched = utils.prefetch_pharmcat_positions(tmp_positions, tmp_reference)
+        if not hasattr(os, 'posix_fadvise'):
+            assert prefetched == []
+            return
+        assert prefetched == files
+        # the reference FASTA itself is too big to be worth prefetching
+        assert tmp_reference not in prefetched
+
+
 def test_delete_vcf_and_index():
     with tempfile.TemporaryDirectory() as td:
         tmp_dir: Path = Path(td)
@@ -419,6 +559,67 @@ def test_prep_pharmcat_positions():
             (helpers.uniallelic_pharmcat_positions_file.name, helpers.pharmcat_positions_file.name)
 
 
+def test_prep_pharmcat_positions_stamp():
+    with tempfile.TemporaryDirectory() as td:
+        tmp_dir: Path = Path(td)
+        tmp_positions = tmp_dir / preprocessor.PHARMCAT_POSITIONS_FILENAME
+        tmp_reference = tmp_dir / preprocessor.REFERENCE_FASTA_FILENAME
+        tmp_uniallelic = tmp_dir / preprocessor.UNIALLELIC_VCF_FILENAME
+        # derived files already exist, so nothing needs to be generated
+        for file in [tmp_positions, tmp_reference, tmp_uniallelic, Path(str(tmp_positions) + '.csi'),
+                     Path(str(tmp_uniallelic) + '.csi')]:
+            helpers.touch(file)
+        uniallelic_mtime = tmp_uniallelic.stat().st_mtime_ns
+
+        stamp_file = tmp_dir / preprocessor.PREP_STAMP_FILENAME
+        assert not stamp_file.is_file()
+        utils.prep_pharmcat_positions(tmp_positions, tmp_reference, verbose=1)
+        assert stamp_file.is_file()
+        stamp = stamp_file.read_text()
+
+        utils.prep_pharmcat_positions(tmp_positions, tmp_reference, verbose=1)
+        assert stamp == stamp_file.read_text()
+        assert uniallelic_mtime == tmp_uniallelic.stat().st_mtime_ns
+
+        # stamp does not change when the directory is moved
+        moved_dir = tmp_dir / 'moved'
+        moved_dir.mkdir()
+        moved_positions = Path(shutil.copy2(tmp_positions, moved_dir))
+        moved_reference = Path(shutil.copy2(tmp_reference, moved_dir))
+        assert stamp.strip() == utils._get_prep_stamp(moved_positions, moved_reference)
+
+        # stamp changes when inputs change
+        helpers.touch(tmp_reference, 'ACGT')
+        assert stamp.strip() != utils._get_prep_stamp(tmp_positions, tmp_reference)
+
+
+def test_prep_pharmcat_positions_stale():
+    reference_fasta = helpers.pharmcat_positions_file.parent / preprocessor.REFERENCE_FASTA_FILENAME
+    assert reference_fasta.is_file(), 'Cannot find reference FASTA for testing!'
+    with tempfile.TemporaryDirectory() as td:
+        tmp_dir: Path = Path(td)
+        tmp_positions = tmp_dir / helpers.pharmcat_positions_file.name
+        shutil.copyfile(helpers.pharmcat_positions_file, tmp_positions)
+        tmp_uniallelic = tmp_dir / preprocessor.UNIALLELIC_VCF_FILENAME
+
+        utils.prep_pharmcat_positions(tmp_positions, reference_fasta, verbose=1)
+        assert tmp_uniallelic.is_file()
+        assert Path(str(tmp_uniallelic) + '.csi').is_file()
+        stamp_file = tmp_dir / preprocessor.PREP_STAMP_FILENAME
+        stamp = stamp_file.read_text()
+
+        # updated positions file makes derived files stale, and their existing indexes must not get in the way
+        os.utime(tmp_positions, ns=(1_000_000_000, 1_000_000_000))
+        os.utime(tmp_uniallelic, ns=(1_000_000_000, 1_000_000_000))
+        utils.prep_pharmcat_positions(tmp_positions, reference_fasta, verbose=1)
+        assert stamp != stamp_file.read_text()
+        assert tmp_uniallelic.stat().st_mtime_ns > 1_000_000_000
+        assert Path(str(tmp_positions) + '.csi').is_file()
+        assert Path(str(tmp_uniallelic) + '.csi').is_file()
+        # temporary build directories are cleaned up
+        assert [f for f in os.listdir(tmp_dir) if f.startswith('tmp')] == []
+
+
 def test_extract_pgx_regions():
     vcf_file = helpers.test_dir / 'raw.vcf.bgz'
     vcf_file1 = helpers.test_dir / 'raw-p1.vcf.bgz'
@@ -467,6 +668,24 @@ def test_normalize_vcf():
         # shutil.copyfile(normalized_vcf, vcf_file.parent / 'test.normalized.vcf.bgz')
 
 
+def test_normalize_vcf_concurrent():
+    reference_fasta: Path = helpers.get_reference_fasta(helpers.pharmcat_positions_file)
+
+    vcf_file = helpers.test_dir / 'test.pgx_regions.vcf.bgz'
+    with tempfile.TemporaryDirectory() as td:
+        tmp_dir = Path(td)
+        tmp_vcf = tmp_dir / vcf_file.name
+        shutil.copyfile(vcf_file, tmp_vcf)
+        utils.index_vcf(tmp_vcf)
+        assert len(utils.read_vcf_contigs(tmp_vcf)) > 1
+
+        normalized_vcf = utils.normalize_vcf(reference_fasta, tmp_vcf, tmp_dir, 'test', verbose=1)
+        concurrent_vcf = utils.normalize_vcf(reference_fasta, tmp_vcf, tmp_dir, 'test_concurrent',
+                                             concurrent_mode=True, max_processes=2, verbose=1)
+        assert concurrent_vcf.is_file()
+        assert helpers.read_vcf(normalized_vcf, bgzipped=True) == helpers.read_vcf(concurrent_vcf, bgzipped=True)
+
+
 def test_extract_pgx_variants():
     reference_fasta: Path = helpers.get_reference_fasta(helpers.pharmcat_positions_file)
 
@@ -534,6 +753,93 @@ def test_export_single_sample_concurrent():
         helpers.compare_vcf_files(s2_file, tmp_dir, basename, 'Sample_2')
 
 
+def test_split_vcf_by_sample():
+    vcf_file = helpers.test_dir / 'raw.preprocessed.vcf'
+    with tempfile.TemporaryDirectory() as td:
+        tmp_dir = Path(td)
+        tmp_vcf = tmp_dir / vcf_file.name
+        shutil.copyfile(vcf_file, tmp_vcf)
+        split_dir = tmp_dir / 'split'
+        split_dir.mkdir()
+        view_dir = tmp_dir / 'view'
+        view_dir.mkdir()
+
+        samples = ['Sample_1', 'Sample_2']
+        sample_vcfs = utils._split_vcf_by_sample(tmp_vcf, samples, split_dir)
+        assert sample_vcfs is not None
+        assert list(sample_vcfs.keys()) == samples
+
+        # "bcftools +split" must produce the same output as "bcftools view -s"
+        basename = 'test_split'
+        for sample in samples:
+            split_vcf = utils._export_single_sample(sample_vcfs[sample], split_dir, basename, sample, True,
+                                                    presplit=True)
+            view_vcf = utils._export_single_sample(tmp_vcf, view_dir, basename, sample, True)
+            assert helpers.read_vcf(view_vcf) == helpers.read_vcf(split_vcf), '%s mismatch' % sample
+
+        # sample that isn't in the VCF
+        missing_dir = tmp_dir / 'missing'
+        missing_dir.mkdir()
+        assert utils._split_vcf_by_sample(tmp_vcf, ['Sample_1', 'foo'], missing_dir) is None
+
+
+def test_export_single_sample_without_split(monkeypatch):
+    vcf_file = helpers.test_dir / 'raw.preprocessed.vcf'
+    s1_file = helpers.test_dir / 'raw.Sample_1.preprocessed.vcf'
+    s2_file = helpers.test_dir / 'raw.Sample_2.preprocessed.vcf'
+    # pretend "bcftools +split" is not available, so samples are exported one at a time
+    monkeypatch.setattr(utils, '_split_vcf_by_sample', lambda *args, **kwargs: None)
+    with tempfile.TemporaryDirectory() as td:
+        tmp_dir = Path(td)
+        tmp_vcf = tmp_dir / vcf_file.name
+        shutil.copyfile(vcf_file, tmp_vcf)
+
+        basename = 'test_no_split'
+        utils.export_single_sample_vcf(tmp_vcf, ['Sample_1', 'Sample_2'], tmp_dir, basename, concurrent_mode=True,
+                                       max_processes=2)
+
+        helpers.compare_vcf_files(s1_file, tmp_dir, basename, 'Sample_1')
+        helpers.compare_vcf_files(s2_file, tmp_dir, basename, 'Sample_2')
+
+
+def test_get_cpu_count():
+    cpu_count = utils.get_cpu_count()
+    assert 1 <= cpu_count <= os.cpu_count()
+    assert utils.check_max_processes(cpu_count + 1, validate=False) <= max(2, cpu_count)
+
+
+def test_read_cgroup_cpu_limit():
+    with tempfile.TemporaryDirectory() as td:
+        cpu_max_file = Path(td, 'cpu.max')
+        assert utils._read_cgroup_cpu_limit(cpu_max_file) is None
+
+        cpu_max_file.write_text('max 100000\n')
+        assert utils._read_cgroup_cpu_limit(cpu_max_file) is None
+
+        cpu_max_file.write_text('200000 100000\n')
+        assert 2 == utils._read_cgroup_cpu_limit(cpu_max_file)
+
+        cpu_max_file.write_text('150000 100000\n')
+        assert 2 == utils._read_cgroup_cpu_limit(cpu_max_file)
+
+        cpu_max_file.write_text('50000 100000\n')
+        assert 1 == utils._read_cgroup_cpu_limit(cpu_max_file)
+
+
+def test_get_executor():
+    executor = utils.get_executor(2)
+    assert executor is utils.get_executor(2)
+    assert 2 == executor.submit(lambda: 2).result()
+
+    max_processes = utils.check_max_processes(2, validate=False)
+    if max_processes != utils.check_max_processes(1, validate=False):
+        # new pool for different number of workers
+        assert executor is not utils.get_executor(1)
+        # but the old one is still usable
+        assert executor is utils.get_executor(2)
+        assert 2 == executor.submit(lambda: 2).result()
+
+
 def test_check_max_memory():
     assert utils.check_max_memory(None) is None
     assert utils.check_max_memory('') is None